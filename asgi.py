@@ -0,0 +1,281 @@
+"""
+ASGI entry point: uvicorn asgi:application --workers 4
+
+What runs where:
+  /get_regions, /get_constituencies, /get_candidates, /geography
+      async handlers reading the in-process geography cache; a background task reloads
+      it through the aiomysql pool, so these never touch MySQL on the request path
+  /detect_face
+      async handler; the embedding runs in a process pool, the face index refresh and
+      the username lookup go through the aiomysql pool on the primary
+  /chat, /chat_history, /clear_chat_history
+      async handlers; the OpenAI call is awaited, chat history file I/O runs in threads
+  /admin/stream
+      async handler fed by the tally hub's poller thread in e_voting, which still reads
+      MySQL with mysql.connector
+  everything else
+      the Flask app through an a2wsgi bridge with WSGI_BRIDGE_THREADS threads. This
+      includes login, registration and OTP mail: they render templates, flash messages
+      and send SMTP synchronously, so each of those requests holds a bridge thread.
+"""
+import os
+import queue
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import aiomysql
+import openai
+from a2wsgi import WSGIMiddleware
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Mount, Route
+
+import e_voting
+from face_embedding import get_face_encoding
+from e_voting import (
+    app as flask_app, geography_cache, chatbot_request, chatbot_fallback_response,
+    log_chat_message, read_chat_history, clear_chat_history_file,
+    face_index, nearest_voter_id, FACE_INDEX_VERSION_QUERY, FACE_INDEX_ROWS_QUERY,
+    GEOGRAPHY_QUERIES, GEOGRAPHY_VERSION_QUERY, GEOGRAPHY_VERSION_CHECK_INTERVAL,
+    GEOGRAPHY_MAX_AGE, chat_log, db_log, face_log, tally_hub,
+    tally_stream_key, TALLY_STREAM_QUEUE_SIZE, TALLY_STREAM_HEARTBEAT
+)
+
+ASYNC_DB_POOL_MIN = int(os.getenv("ASYNC_DB_POOL_MIN", "1"))
+ASYNC_DB_POOL_MAX = int(os.getenv("ASYNC_DB_POOL_MAX", "20"))
+# Worker processes for face embedding; DeepFace holds the GIL for most of its work. They are
+# spawned and import only face_embedding, not the Flask app
+FACE_WORKERS = int(os.getenv("FACE_WORKERS", "2"))
+# Threads serving the routes that still go through the Flask app
+WSGI_BRIDGE_THREADS = int(os.getenv("WSGI_BRIDGE_THREADS", "10"))
+
+pools = {}
+face_executor = None
+refresher_task = None
+
+# ------------------------------------------------------------------------------
+# Async Database Pool
+# ------------------------------------------------------------------------------
+async def create_pool(config: dict):
+    return await aiomysql.create_pool(
+        host=config["host"], port=config["port"], user=config["user"],
+        password=config["password"], db=config["database"],
+        minsize=ASYNC_DB_POOL_MIN, maxsize=ASYNC_DB_POOL_MAX, autocommit=True
+    )
+
+async def fetch_rows(query: str, params=None, readonly: bool = True) -> list:
+    pool = pools["replica" if readonly else "primary"]
+    async with pool.acquire() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute(query, params)
+            return await cur.fetchall()
+
+async def refresh_geography() -> bool:
+    """Reload the dropdown cache when reference_data_version moves, without blocking the loop."""
+    try:
+        rows = await fetch_rows(GEOGRAPHY_VERSION_QUERY)
+        version = rows[0][0] if rows else None
+        if geography_cache.version is not None and version is not None and version == geography_cache.version:
+            return True
+        tables = [await fetch_rows(query) for query in GEOGRAPHY_QUERIES]
+        geography_cache.install(geography_cache.build(version, *tables))
+        return True
+    except Exception as e:
+        geography_cache.stats["load_errors"] += 1
+        db_log.error("Error refreshing geography cache: %s", e)
+        return False
+
+async def geography_refresher():
+    while True:
+        await asyncio.sleep(GEOGRAPHY_VERSION_CHECK_INTERVAL)
+        await refresh_geography()
+
+async def startup():
+    global face_executor, refresher_task
+    pools["primary"] = await create_pool(e_voting.PRIMARY_DB_CONFIG)
+    if e_voting.REPLICA_DB_CONFIGS:
+        pools["replica"] = await create_pool(e_voting.REPLICA_DB_CONFIGS[0])
+    else:
+        pools["replica"] = pools["primary"]
+    face_executor = ProcessPoolExecutor(max_workers=FACE_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    # The refresher task owns reloads from here on; snapshot() must never hit MySQL on the loop,
+    # so a worker that cannot load the hierarchy does not start at all
+    if not await refresh_geography():
+        raise RuntimeError("Could not load the geography cache from MySQL.")
+    geography_cache.check_interval = float("inf")
+    refresher_task = asyncio.create_task(geography_refresher())
+
+async def shutdown():
+    refresher_task.cancel()
+    for pool in {id(p): p for p in pools.values()}.values():
+        if not pool.closed:
+            pool.close()
+            await pool.wait_closed()
+    pools.clear()
+    face_executor.shutdown(wait=False, cancel_futures=True)
+
+# ------------------------------------------------------------------------------
+# Dynamic Dropdown Endpoints
+# ------------------------------------------------------------------------------
+def _int_param(request, name: str):
+    value = request.query_params.get(name)
+    return int(value) if value else None
+
+# These handlers run on the loop, so they only ever peek at the cache the refresher fills
+async def get_regions(request):
+    state_id = _int_param(request, "state_id")
+    return JSONResponse(geography_cache.peek().get("regions_by_state", {}).get(state_id, []) if state_id else [])
+
+async def get_constituencies(request):
+    region_id = _int_param(request, "region_id")
+    return JSONResponse(geography_cache.peek().get("constituencies_by_region", {}).get(region_id, []) if region_id else [])
+
+async def get_candidates(request):
+    constituency_id = _int_param(request, "constituency_id")
+    return JSONResponse(geography_cache.peek().get("candidates_by_constituency", {}).get(constituency_id, []) if constituency_id else [])
+
+async def geography(request):
+    payload = geography_cache.payload(geography_cache.peek())
+    if payload is None:
+        return JSONResponse({"error": "Geography data is temporarily unavailable."}, status_code=503,
+                            headers={"Cache-Control": "no-store", "Retry-After": "30"})
+    # Each encoding is a different representation and needs its own strong ETag
+    encoded = "gzip" in request.headers.get("accept-encoding", "")
+    etag = f'"{payload["etag"]}-gzip"' if encoded else f'"{payload["etag"]}"'
+    headers = {
+        "ETag": etag,
+        "Cache-Control": f"public, max-age={GEOGRAPHY_MAX_AGE}",
+        "Vary": "Accept-Encoding"
+    }
+    if etag in [tag.strip() for tag in request.headers.get("if-none-match", "").split(",")]:
+        return Response(status_code=304, headers=headers)
+    if encoded:
+        headers["Content-Encoding"] = "gzip"
+        return Response(payload["gzip"], media_type="application/json", headers=headers)
+    return Response(payload["body"], media_type="application/json", headers=headers)
+
+# ------------------------------------------------------------------------------
+# Chat and Face Lookup
+# ------------------------------------------------------------------------------
+async def get_chatbot_response(message: str) -> str:
+    try:
+        response = await openai.ChatCompletion.acreate(**chatbot_request(message))
+        return response["choices"][0]["message"]["content"].strip()
+    except Exception as e:
+        chat_log.error("OpenAI API error: %s", e)
+        return chatbot_fallback_response(message)
+
+async def chat(request):
+    data = await request.json()
+    user_message = data.get("message", "")
+    await asyncio.to_thread(log_chat_message, "user", user_message)
+    bot_response = await get_chatbot_response(user_message)
+    await asyncio.to_thread(log_chat_message, "bot", bot_response)
+    return JSONResponse({"response": bot_response})
+
+async def chat_history(request):
+    return JSONResponse(await asyncio.to_thread(read_chat_history))
+
+async def clear_chat_history(request):
+    return JSONResponse({"success": await asyncio.to_thread(clear_chat_history_file)})
+
+async def face_index_snapshot() -> tuple:
+    """The face index, brought up to date through the aiomysql pool when its check is due."""
+    if face_index.due():
+        try:
+            rows = await fetch_rows(FACE_INDEX_VERSION_QUERY, readonly=False)
+            version = tuple(int(v) for v in rows[0])
+            after_id = face_index.fetch_from(version)
+            if after_id is not None:
+                rows = await fetch_rows(FACE_INDEX_ROWS_QUERY, (after_id,), readonly=False)
+                if not face_index.install(version, after_id, rows):
+                    face_index.install(version, 0, await fetch_rows(FACE_INDEX_ROWS_QUERY, (0,), readonly=False))
+        except Exception as e:
+            face_index.stats["load_errors"] += 1
+            face_log.error("Error refreshing face index: %s", e)
+    return face_index.current()
+
+async def detect_face(request):
+    form = await request.form()
+    face_data = form.get("face_data")
+    if not face_data:
+        return JSONResponse({"success": False, "message": "Face data is required."})
+    loop = asyncio.get_running_loop()
+    encoding = await loop.run_in_executor(face_executor, get_face_encoding, face_data)
+    if encoding is None:
+        return JSONResponse({"success": False, "message": "No face detected in the provided data."})
+    voter_ids, index = await face_index_snapshot()
+    voter_id = await asyncio.to_thread(nearest_voter_id, encoding, voter_ids, index)
+    if voter_id is not None:
+        # Read from the primary, which the index was loaded from; a replica may not have the voter yet
+        rows = await fetch_rows("SELECT voter_username FROM voters WHERE voter_id = %s", (voter_id,), readonly=False)
+        if rows:
+            return JSONResponse({"success": True, "voter_username": rows[0][0]})
+    return JSONResponse({"success": False, "message": "No matching voter found."})
+
+# ------------------------------------------------------------------------------
+# Live Results Stream
+# ------------------------------------------------------------------------------
+class LoopQueue(queue.Queue):
+    """TallyHub subscriber queue that wakes a coroutine on the event loop when filled."""
+    def __init__(self, loop, maxsize: int):
+        super().__init__(maxsize)
+        self.loop = loop
+        self.ready = asyncio.Event()
+
+    def _put(self, item):
+        super()._put(item)
+        self.loop.call_soon_threadsafe(self.ready.set)
+
+def is_admin_session(request) -> bool:
+    # The session store only needs the cookie, which Starlette requests carry too
+    session = flask_app.session_interface.open_session(flask_app, request)
+    return session is not None and "user" in session and session.get("login_mode") == "admin"
+
+async def admin_stream(request):
+    if not await asyncio.to_thread(is_admin_session, request):
+        return JSONResponse({"error": "Admin login required."}, status_code=403)
+    key = await asyncio.to_thread(tally_stream_key, request.query_params)
+    if key is None:
+        return JSONResponse({"error": "view_level and area_id are required; election must be a number."}, status_code=400)
+
+    async def stream():
+        events = tally_hub.subscribe(key, LoopQueue(asyncio.get_running_loop(), TALLY_STREAM_QUEUE_SIZE))
+        try:
+            yield "retry: 5000\n\n"
+            while True:
+                try:
+                    event = events.get_nowait()
+                except queue.Empty:
+                    events.ready.clear()
+                    if events.qsize():
+                        continue
+                    try:
+                        await asyncio.wait_for(events.ready.wait(), TALLY_STREAM_HEARTBEAT)
+                    except asyncio.TimeoutError:
+                        yield ": keepalive\n\n"
+                    continue
+                yield f"event: tally\ndata: {event}\n\n"
+        finally:
+            tally_hub.unsubscribe(key, events)
+
+    return StreamingResponse(stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+application = Starlette(
+    routes=[
+        Route("/get_regions", get_regions),
+        Route("/get_constituencies", get_constituencies),
+        Route("/get_candidates", get_candidates),
+        Route("/geography", geography),
+        Route("/chat", chat, methods=["POST"]),
+        Route("/chat_history", chat_history),
+        Route("/clear_chat_history", clear_chat_history, methods=["POST"]),
+        Route("/detect_face", detect_face, methods=["POST"]),
+        Route("/admin/stream", admin_stream),
+        Mount("/", app=WSGIMiddleware(flask_app, workers=WSGI_BRIDGE_THREADS))
+    ],
+    on_startup=[startup],
+    on_shutdown=[shutdown]
+)
@@ -0,0 +1,88 @@
+"""
+Face embedding with DeepFace's "Facenet" model.
+
+Kept apart from e_voting so that process pool workers (bulk enrollment, the ASGI face
+lookup) import only DeepFace, NumPy and Pillow. Importing e_voting in a spawned worker
+would check the schema version, start the log listener, open the ledger and build the
+Flask app once per worker.
+"""
+import json
+import base64
+import logging
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+from deepface import DeepFace
+
+log = logging.getLogger("evoting.face")
+
+def _represent_face(image_array):
+    representation = DeepFace.represent(image_array, model_name="Facenet", enforce_detection=False)
+    if representation and "embedding" in representation[0]:
+        embedding = np.array(representation[0]["embedding"])
+        norm = np.linalg.norm(embedding)
+        if norm > 0:
+            return embedding / norm
+    return None
+
+def decode_face_data(face_data_str) -> list:
+    """Return the raw image bytes held in a base64 data URL or a JSON array of data URLs."""
+    if face_data_str.strip().startswith('['):
+        items = json.loads(face_data_str)
+    else:
+        items = [face_data_str]
+    images = []
+    for data in items:
+        header, encoded = data.split(',', 1)
+        images.append(base64.b64decode(encoded))
+    return images
+
+def compute_face_embedding(images: list):
+    """
+    Embed raw image bytes with DeepFace's "Facenet" model. The embedding is L2 normalized;
+    for several frames the normalized average is returned.
+    """
+    embeddings = []
+    for img_data in images:
+        image = np.array(Image.open(BytesIO(img_data)))
+        embedding = _represent_face(image)
+        if embedding is not None:
+            embeddings.append(embedding)
+    if embeddings:
+        avg_embedding = np.mean(embeddings, axis=0)
+        norm = np.linalg.norm(avg_embedding)
+        if norm > 0:
+            return avg_embedding / norm
+    return None
+
+def get_face_encoding(face_data_str):
+    """
+    Given a base64 data URL of an image or a JSON array of such images,
+    decode it, load it as a NumPy array, and then use DeepFace with the "Facenet" model
+    to obtain a robust face embedding. The embedding is L2 normalized.
+    If multiple images are provided, returns the average normalized embedding.
+    """
+    try:
+        return compute_face_embedding(decode_face_data(face_data_str))
+    except Exception as e:
+        log.error("Error decoding face data: %s", e)
+    return None
+
+def embedding_to_bytes(embedding) -> bytes:
+    return np.asarray(embedding, dtype=np.float32).tobytes()
+
+def embedding_from_bytes(data) -> np.ndarray:
+    return np.frombuffer(data, dtype=np.float32)
+
+def embed_image_file(path: str) -> tuple:
+    """Process pool worker for bulk enrollment: returns (embedding bytes, None) or (None, reason)."""
+    try:
+        with open(path, "rb") as f:
+            img_data = f.read()
+        embedding = compute_face_embedding([img_data])
+        if embedding is None:
+            return None, "no face detected"
+        return embedding_to_bytes(embedding), None
+    except Exception as e:
+        return None, f"unreadable image: {e}"
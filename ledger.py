@@ -0,0 +1,872 @@
+"""
+Append-only vote ledger.
+
+Blocks are written to numbered segment files under the ledger directory as fixed-framed
+binary records:
+
+    header   magic, record kind, payload length, index, timestamp, prev hash, block hash
+    payload  compact UTF-8 JSON
+    trailer  CRC32 of header + payload
+
+A block hash is sha256(prev hash || kind || index || timestamp || payload), so changing any
+block breaks the link of every block after it. The "tail" file points at the end of the
+last committed block (segment, offset, index, hash), which makes appends and the current
+chain head O(1) to find.
+
+Appends are group committed: callers queue their payloads and block while a writer
+thread writes everything queued within commit_interval as one write and one fsync.
+Workers share the files through an flock on the "lock" file; the writer re-reads the
+tail pointer under that lock so blocks from every process land on a single chain.
+
+Every commit that contains votes ends with a seal record: the Merkle root over the
+vote_hash values of the votes in that batch, chained to the previous seal's root. A vote's
+inclusion proof is the O(log n) path from its vote_hash to the root of its seal.
+
+"voters.idx" is a secondary index of fixed-size (voter_id, index, segment, offset) entries
+appended in the same commit as the blocks they point at. Each process reads only the
+entries added since its last lookup, so fetching a voter's receipts does not depend on
+the size of the ledger.
+
+Every snapshot_interval blocks the index is compacted into "snapshot": the tail state
+followed by the index entries sorted by voter_id. The merge runs outside the lock from a
+tail captured under it; the lock is only retaken to swap the snapshot in and start the
+next index generation ("voters.<n>.idx") with the entries appended meanwhile, after which
+the folded generation is deleted. A process maps the snapshot and binary-searches it in
+place, replaying only the current generation, and segment files are read through a small
+LRU of read-only memory maps. Neither startup time, resident memory nor the index suffix
+on disk grows with the number of votes.
+"""
+import os
+import hmac
+import json
+import time
+import zlib
+import mmap
+import fcntl
+import struct
+import hashlib
+import itertools
+import logging
+import threading
+import contextlib
+import multiprocessing
+from collections import deque, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+log = logging.getLogger("evoting.vote.ledger")
+
+LEDGER_MAGIC = b"EVL1"
+HEADER = struct.Struct(">4sBIQd32s32s")
+TRAILER = struct.Struct(">I")
+TAIL = struct.Struct(">4sIQQ32s32s")
+VOTER_INDEX = struct.Struct(">QQIQ")
+SNAPSHOT = struct.Struct(">4sIQQ32s32sQQ")
+SNAPSHOT_MAGIC = b"EVS2"
+GENESIS_HASH = bytes(32)
+
+RECORD_VOTE = 1
+RECORD_SEAL = 2
+
+class LedgerError(Exception):
+    """A record that is torn, corrupt or out of sequence."""
+
+def compute_block_hash(prev_hash: bytes, kind: int, index: int, timestamp: float, payload: bytes) -> bytes:
+    digest = hashlib.sha256(prev_hash)
+    digest.update(struct.pack(">BQd", kind, index, timestamp))
+    digest.update(payload)
+    return digest.digest()
+
+def encode_record(kind: int, index: int, timestamp: float, prev_hash: bytes, payload: bytes) -> tuple:
+    block_hash = compute_block_hash(prev_hash, kind, index, timestamp, payload)
+    header = HEADER.pack(LEDGER_MAGIC, kind, len(payload), index, timestamp, prev_hash, block_hash)
+    return header + payload + TRAILER.pack(zlib.crc32(header + payload)), block_hash
+
+def decode_record(buf, pos: int = 0):
+    """
+    Decode the record starting at buf[pos]. Returns (header fields, payload bytes, end) or
+    None at a clean end of buffer; raises LedgerError for torn or corrupt records.
+    """
+    if pos >= len(buf):
+        return None
+    if pos + HEADER.size > len(buf):
+        raise LedgerError("torn header")
+    fields = HEADER.unpack_from(buf, pos)
+    if fields[0] != LEDGER_MAGIC:
+        raise LedgerError("bad magic")
+    length = fields[2]
+    end = pos + HEADER.size + length + TRAILER.size
+    if end > len(buf):
+        raise LedgerError("torn record")
+    payload = bytes(buf[pos + HEADER.size:end - TRAILER.size])
+    (crc,) = TRAILER.unpack_from(buf, end - TRAILER.size)
+    if zlib.crc32(bytes(buf[pos:end - TRAILER.size])) != crc:
+        raise LedgerError("checksum mismatch")
+    return fields, payload, end
+
+# ------------------------------------------------------------------------------
+# Merkle trees over vote hashes
+# ------------------------------------------------------------------------------
+# Leaves and inner nodes are hashed with different prefixes so that an inner node can
+# never be passed off as a vote. An odd node at the end of a level is carried up as is.
+def merkle_leaf(vote_hash: str) -> bytes:
+    return hashlib.sha256(b"\x00" + bytes.fromhex(vote_hash)).digest()
+
+def merkle_node(left: bytes, right: bytes) -> bytes:
+    return hashlib.sha256(b"\x01" + left + right).digest()
+
+def merkle_levels(vote_hashes: list) -> list:
+    levels = [[merkle_leaf(vote_hash) for vote_hash in vote_hashes]]
+    while len(levels[-1]) > 1:
+        level = levels[-1]
+        levels.append([merkle_node(level[i], level[i + 1]) if i + 1 < len(level) else level[i]
+                       for i in range(0, len(level), 2)])
+    return levels
+
+def merkle_root(vote_hashes: list) -> bytes:
+    return merkle_levels(vote_hashes)[-1][0] if vote_hashes else GENESIS_HASH
+
+def merkle_proof(vote_hashes: list, position: int) -> list:
+    """Sibling hashes from the leaf at position up to the root."""
+    proof = []
+    for level in merkle_levels(vote_hashes)[:-1]:
+        sibling = position ^ 1
+        if sibling < len(level):
+            proof.append({"side": "left" if sibling < position else "right", "hash": level[sibling].hex()})
+        position //= 2
+    return proof
+
+def verify_merkle_proof(vote_hash: str, proof: list, root: str) -> bool:
+    node = merkle_leaf(vote_hash)
+    for step in proof:
+        sibling = bytes.fromhex(step["hash"])
+        node = merkle_node(sibling, node) if step["side"] == "left" else merkle_node(node, sibling)
+    return node.hex() == root
+
+def make_block(fields, payload: bytes, segment: int, offset: int, end: int) -> dict:
+    _, kind, _, index, timestamp, prev_hash, block_hash = fields
+    block = json.loads(payload)
+    block.update({
+        "kind": kind,
+        "index": index,
+        "timestamp": datetime.fromtimestamp(timestamp).isoformat(),
+        "prev_hash": prev_hash.hex(),
+        "block_hash": block_hash.hex(),
+        "segment": segment,
+        "offset": offset,
+        "end": end
+    })
+    return block
+
+# ------------------------------------------------------------------------------
+# Verification
+# ------------------------------------------------------------------------------
+def verify_segment(directory: str, segment: int, offset: int = 0, stop: int = None) -> dict:
+    """
+    Check one segment (from offset up to stop) on its own: record checksums, block hashes,
+    links between consecutive blocks and every seal's Merkle root. Links that cross into
+    the segment are returned for the caller to stitch. Runs in a worker process.
+    """
+    result = {"segment": segment, "blocks": 0, "first": None, "last": None,
+              "first_prev_root": None, "seal_root": None, "votes": [], "errors": []}
+    with open(os.path.join(directory, f"{segment:08d}.seg"), "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        buf = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)) if size else b""
+    buf = buf[:size if stop is None else stop]
+    pos, prev, leaves = offset, None, []
+    while True:
+        try:
+            record = decode_record(buf, pos)
+        except LedgerError as e:
+            result["errors"].append(f"{e} at {segment}:{pos}")
+            break
+        if record is None:
+            break
+        fields, payload, end = record
+        _, kind, _, index, timestamp, prev_hash, block_hash = fields
+        if compute_block_hash(prev_hash, kind, index, timestamp, payload) != block_hash:
+            result["errors"].append(f"Block {index} does not match its hash")
+        if prev is None:
+            result["first"] = {"index": index, "prev_hash": prev_hash.hex()}
+        elif index != prev[0] + 1 or prev_hash != prev[1]:
+            result["errors"].append(f"Block {index} does not link to block {prev[0]}")
+        body = json.loads(payload)
+        if kind == RECORD_VOTE and body.get("vote_hash"):
+            leaves.append(body["vote_hash"])
+            result["votes"].append((body["vote_hash"], body.get("voter_id"), body.get("election_id"),
+                                    body.get("candidate_id"), index))
+        elif kind == RECORD_SEAL:
+            if body["count"] != len(leaves) or merkle_root(leaves).hex() != body["root"]:
+                result["errors"].append(f"Seal {index} does not match the Merkle root of its votes")
+            if result["seal_root"] is None:
+                result["first_prev_root"] = body["prev_root"]
+            elif body["prev_root"] != result["seal_root"]:
+                result["errors"].append(f"Seal {index} does not chain to the previous seal")
+            result["seal_root"] = body["root"]
+            leaves = []
+        prev = (index, block_hash)
+        result["blocks"] += 1
+        pos = end
+    if leaves:
+        result["errors"].append(f"{len(leaves)} votes at the end of segment {segment} are not sealed")
+    if prev is not None:
+        result["last"] = {"index": prev[0], "hash": prev[1].hex()}
+    return result
+
+def release_map(mapped: mmap.mmap):
+    """Close a map dropped from a cache; one a reader still holds a view of is closed when the view goes."""
+    try:
+        mapped.close()
+    except BufferError:
+        pass
+
+def sign_checkpoint(checkpoint: dict, key: bytes) -> str:
+    body = json.dumps({k: v for k, v in checkpoint.items() if k != "signature"}, sort_keys=True).encode("utf-8")
+    return hmac.new(key, body, hashlib.sha256).hexdigest()
+
+class VoteLedger:
+    def __init__(self, directory: str, segment_size: int = 64 * 1024 * 1024,
+                 commit_interval: float = 0.005, commit_batch: int = 512, snapshot_interval: int = 100000,
+                 max_mapped_segments: int = 8):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.commit_interval = commit_interval
+        self.commit_batch = commit_batch
+        self._cond = threading.Condition()
+        self._pending = []
+        self._writer = None
+        self._writer_pid = None
+        self.snapshot_interval = snapshot_interval
+        self._index_lock = threading.Lock()
+        self._voter_index = {}
+        self._index_read = 0
+        self._snapshot = None
+        self._snapshotter = None
+        self.max_mapped_segments = max_mapped_segments
+        self._maps_lock = threading.Lock()
+        self._maps = OrderedDict()
+        self.stats = {"appends": 0, "commits": 0, "recovered": 0}
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def segment_path(self, segment: int) -> str:
+        return self._path(f"{segment:08d}.seg")
+
+    def segments(self) -> list:
+        return sorted(int(name[:-4]) for name in os.listdir(self.directory) if name.endswith(".seg"))
+
+    # --------------------------------------------------------------------------
+    # Tail pointer
+    # --------------------------------------------------------------------------
+    def read_tail(self) -> dict:
+        """End of the last committed block, or the genesis position for an empty ledger."""
+        try:
+            with open(self._path("tail"), "rb") as f:
+                magic, segment, offset, index, block_hash, seal_root = TAIL.unpack(f.read(TAIL.size))
+            if magic == LEDGER_MAGIC:
+                return {"segment": segment, "offset": offset, "index": index, "hash": block_hash, "seal_root": seal_root}
+        except (OSError, struct.error):
+            pass
+        # A missing or unreadable pointer only costs a walk in _recover() from the snapshot
+        return self._snapshot_tail() or {"segment": 0, "offset": 0, "index": 0, "hash": GENESIS_HASH, "seal_root": GENESIS_HASH}
+
+    def _write_tail(self, tail: dict):
+        tmp = self._path(f"tail.{os.getpid()}")
+        with open(tmp, "wb") as f:
+            f.write(TAIL.pack(LEDGER_MAGIC, tail["segment"], tail["offset"], tail["index"], tail["hash"], tail["seal_root"]))
+        os.replace(tmp, self._path("tail"))
+
+    def _recover(self) -> dict:
+        """
+        Start from the tail pointer and walk forward over any blocks committed after it was
+        last written (a crash between fsync and the pointer update). Called under the lock.
+        """
+        tail = self.read_tail()
+        try:
+            for block in self.iter_blocks(tail["segment"], tail["offset"]):
+                if block["index"] != tail["index"] + 1 or block["prev_hash"] != tail["hash"].hex():
+                    break
+                tail = {"segment": block["segment"], "offset": block["end"], "index": block["index"],
+                        "hash": bytes.fromhex(block["block_hash"]),
+                        "seal_root": bytes.fromhex(block["root"]) if block["kind"] == RECORD_SEAL else tail["seal_root"]}
+                self.stats["recovered"] += 1
+        except LedgerError as e:
+            log.error("Ledger recovery stopped at a damaged record: %s", e)
+        return tail
+
+    # --------------------------------------------------------------------------
+    # Reading
+    # --------------------------------------------------------------------------
+    def _read_segment(self, segment: int, offset: int = 0) -> bytes:
+        with open(self.segment_path(segment), "rb") as f:
+            f.seek(offset)
+            return f.read()
+
+    def _segment_view(self, segment: int, end: int) -> memoryview:
+        """
+        Read-only map of a segment covering at least end bytes. Committed bytes never change,
+        so a map is reused until a reader needs blocks appended after it was made.
+        """
+        with self._maps_lock:
+            mapped = self._maps.get(segment)
+            if mapped is None or len(mapped) < end:
+                with open(self.segment_path(segment), "rb") as f:
+                    if os.fstat(f.fileno()).st_size < max(end, 1):
+                        raise LedgerError(f"Segment {segment} ends before offset {end}")
+                    if mapped is not None:
+                        release_map(mapped)
+                    mapped = self._maps[segment] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._maps.move_to_end(segment)
+            while len(self._maps) > self.max_mapped_segments:
+                release_map(self._maps.popitem(last=False)[1])
+            return memoryview(mapped)
+
+    def iter_blocks(self, segment: int = 0, offset: int = 0, stop: dict = None):
+        """
+        Yield blocks from (segment, offset) onwards. Readers pass the committed tail as stop:
+        committed bytes are read through the segment maps and a batch still being written is
+        never returned. Without stop (recovery, under the lock) whatever is on disk is read.
+        """
+        for seg in self.segments():
+            if seg < segment or (stop and seg > stop["segment"]):
+                continue
+            pos = offset if seg == segment else 0
+            if stop:
+                limit = stop["offset"] if seg == stop["segment"] else os.path.getsize(self.segment_path(seg))
+                buf, base = (self._segment_view(seg, limit)[:limit], 0) if limit > pos else (b"", pos)
+            else:
+                buf, base = self._read_segment(seg, pos), pos
+            while True:
+                try:
+                    record = decode_record(buf, pos - base)
+                except LedgerError as e:
+                    raise LedgerError(f"{e} at {seg}:{pos}") from None
+                if record is None:
+                    break
+                fields, payload, end = record
+                yield make_block(fields, payload, seg, pos, base + end)
+                pos = base + end
+
+    def blocks(self):
+        """All committed blocks, oldest first."""
+        return self.iter_blocks(stop=self.read_tail())
+
+    def read_block(self, segment: int, offset: int) -> dict:
+        view = self._segment_view(segment, offset + HEADER.size)
+        end = offset + HEADER.size + HEADER.unpack_from(view, offset)[2] + TRAILER.size
+        if end > len(view):
+            view = self._segment_view(segment, end)
+        try:
+            fields, payload, end = decode_record(view[:end], offset)
+        except LedgerError as e:
+            raise LedgerError(f"{e} at {segment}:{offset}") from None
+        return make_block(fields, payload, segment, offset, end)
+
+    # --------------------------------------------------------------------------
+    # Seals and inclusion proofs
+    # --------------------------------------------------------------------------
+    def find_seal(self, block: dict) -> dict:
+        """The seal closing the commit that wrote block; it follows the batch in the same segment."""
+        candidate = block
+        while candidate["kind"] != RECORD_SEAL:
+            candidate = self.read_block(block["segment"], candidate["end"])
+        return candidate
+
+    def sealed_vote_hashes(self, seal: dict) -> list:
+        """The leaves of a seal, read back in one pass over its batch."""
+        buf = self._segment_view(seal["segment"], seal["offset"])[:seal["offset"]]
+        vote_hashes, pos = [], seal["start"]
+        while True:
+            record = decode_record(buf, pos)
+            if record is None:
+                return vote_hashes
+            fields, payload, pos = record
+            if fields[1] == RECORD_VOTE:
+                vote_hash = json.loads(payload).get("vote_hash")
+                if vote_hash:
+                    vote_hashes.append(vote_hash)
+
+    def inclusion_proof(self, voter_id: int, vote_hash: str) -> dict:
+        """Merkle path proving vote_hash is sealed in the ledger, or None if it is not there."""
+        block = next((b for b in self.voter_blocks(voter_id) if b.get("vote_hash") == vote_hash), None)
+        if block is None:
+            return None
+        seal = self.find_seal(block)
+        vote_hashes = self.sealed_vote_hashes(seal)
+        position = vote_hashes.index(vote_hash)
+        return {
+            "vote_hash": vote_hash,
+            "block_index": block["index"],
+            "block_hash": block["block_hash"],
+            "leaf_index": position,
+            "leaf_count": len(vote_hashes),
+            "proof": merkle_proof(vote_hashes, position),
+            "merkle_root": seal["root"],
+            "seal": {
+                "index": seal["index"],
+                "block_hash": seal["block_hash"],
+                "prev_hash": seal["prev_hash"],
+                "prev_root": seal["prev_root"],
+                "timestamp": seal["timestamp"]
+            }
+        }
+
+    # --------------------------------------------------------------------------
+    # Per-voter index
+    # --------------------------------------------------------------------------
+    def _sync_index(self, tail: dict, blocks: list = ()):
+        """
+        Append index entries for vote blocks up to tail that the index does not cover yet
+        (a crash between the segment and index writes, or a ledger that predates the
+        index), then for the given new blocks. Called under the lock.
+        """
+        header = self._read_snapshot_header()
+        fd = os.open(self._index_path(header["generation"] if header else 0), os.O_RDWR | os.O_CREAT, 0o644)
+        with os.fdopen(fd, "r+b") as f:
+            size = f.seek(0, os.SEEK_END)
+            size -= size % VOTER_INDEX.size
+            f.truncate(size)
+            segment, offset, last_index = 0, 0, 0
+            if size:
+                f.seek(size - VOTER_INDEX.size)
+                _, last_index, segment, offset = VOTER_INDEX.unpack(f.read(VOTER_INDEX.size))
+                offset = self.read_block(segment, offset)["end"]
+            elif header:
+                # A fresh generation starts where the snapshot that opened it ends
+                segment, offset, last_index = header["segment"], header["offset"], header["index"]
+            missing = []
+            if last_index < tail["index"]:
+                missing = list(self.iter_blocks(segment, offset, stop=tail))
+            entries = [VOTER_INDEX.pack(block["voter_id"], block["index"], block["segment"], block["offset"])
+                       for block in itertools.chain(missing, blocks)
+                       if block["kind"] == RECORD_VOTE and block["index"] > last_index and "voter_id" in block]
+            if entries:
+                f.seek(size)
+                f.write(b"".join(entries))
+                f.flush()
+                os.fsync(f.fileno())
+
+    def _index_path(self, generation: int) -> str:
+        # Generation 0 keeps the original name, so a ledger from before rotation keeps its index
+        return self._path("voters.idx" if generation == 0 else f"voters.{generation}.idx")
+
+    def _refresh_index(self):
+        for _ in range(3):
+            with self._index_lock:
+                self._map_snapshot()
+                generation = self._snapshot["generation"] if self._snapshot else 0
+                try:
+                    f = open(self._index_path(generation), "rb")
+                except FileNotFoundError:
+                    f = None
+                if f is not None:
+                    with f:
+                        if f.seek(0, os.SEEK_END) < self._index_read:
+                            self._voter_index, self._index_read = {}, 0
+                        f.seek(self._index_read)
+                        data = f.read()
+                    data = data[:len(data) - len(data) % VOTER_INDEX.size]
+                    for voter_id, _, segment, offset in VOTER_INDEX.iter_unpack(data):
+                        locations = self._voter_index.setdefault(voter_id, [])
+                        if (segment, offset) not in locations:
+                            locations.append((segment, offset))
+                    self._index_read += len(data)
+                    return
+            header = self._read_snapshot_header()
+            if (header["generation"] if header else 0) != generation:
+                continue  # rotated after the snapshot was mapped; map the new one
+            if self.read_tail()["index"] <= (header["index"] if header else 0):
+                return
+            with self._locked():
+                self._sync_index(self._recover())
+
+    def voter_blocks(self, voter_id: int) -> list:
+        """A voter's vote blocks, oldest first."""
+        self._refresh_index()
+        locations = self._snapshot_locations(voter_id)
+        locations += [location for location in self._voter_index.get(voter_id, []) if location not in locations]
+        return [self.read_block(segment, offset) for segment, offset in locations]
+
+    # --------------------------------------------------------------------------
+    # Snapshots
+    # --------------------------------------------------------------------------
+    def _read_snapshot_header(self) -> dict:
+        try:
+            with open(self._path("snapshot"), "rb") as f:
+                magic, segment, offset, index, block_hash, seal_root, generation, count = SNAPSHOT.unpack(f.read(SNAPSHOT.size))
+        except (OSError, struct.error):
+            return None
+        if magic != SNAPSHOT_MAGIC:
+            return None
+        return {"segment": segment, "offset": offset, "index": index, "hash": block_hash, "seal_root": seal_root,
+                "generation": generation, "count": count}
+
+    def _snapshot_tail(self) -> dict:
+        header = self._read_snapshot_header()
+        return {k: header[k] for k in ("segment", "offset", "index", "hash", "seal_root")} if header else None
+
+    def _map_snapshot(self):
+        """Map the snapshot if it was replaced since the last lookup. Called under _index_lock."""
+        path = self._path("snapshot")
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return
+        if self._snapshot and self._snapshot["id"] == (stat.st_ino, stat.st_mtime_ns):
+            return
+        with open(path, "rb") as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, segment, offset, index, block_hash, seal_root, generation, count = SNAPSHOT.unpack_from(mapped)
+        if magic != SNAPSHOT_MAGIC or len(mapped) != SNAPSHOT.size + count * VOTER_INDEX.size:
+            log.error("Ignoring a damaged ledger snapshot")
+            release_map(mapped)
+            return
+        # The previous map is left to the garbage collector: a lookup may still be searching it
+        self._snapshot = {
+            "id": (stat.st_ino, stat.st_mtime_ns),
+            "map": mapped,
+            "count": count,
+            "generation": generation,
+            "tail": {"segment": segment, "offset": offset, "index": index, "hash": block_hash, "seal_root": seal_root}
+        }
+        # Everything before this generation is in the map; only the generation is replayed into memory
+        self._voter_index, self._index_read = {}, 0
+
+    def _snapshot_locations(self, voter_id: int) -> list:
+        snapshot = self._snapshot
+        if snapshot is None:
+            return []
+        mapped, count = snapshot["map"], snapshot["count"]
+        lo, hi = 0, count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if VOTER_INDEX.unpack_from(mapped, SNAPSHOT.size + mid * VOTER_INDEX.size)[0] < voter_id:
+                lo = mid + 1
+            else:
+                hi = mid
+        locations = []
+        for position in range(lo, count):
+            entry_voter_id, _, segment, offset = VOTER_INDEX.unpack_from(mapped, SNAPSHOT.size + position * VOTER_INDEX.size)
+            if entry_voter_id != voter_id:
+                break
+            locations.append((segment, offset))
+        return locations
+
+    def _snapshot_due(self, tail: dict) -> bool:
+        snapshot = self._snapshot_tail()
+        return tail["index"] - (snapshot["index"] if snapshot else 0) >= self.snapshot_interval
+
+    def write_snapshot(self, force: bool = True) -> dict:
+        """
+        Fold the current index generation into a new snapshot. The tail and the generation's
+        size are captured under the lock; the merge with the previous snapshot runs without
+        it, so commits in every worker carry on meanwhile. The lock is retaken only to move
+        the entries appended since into the next generation and swap the snapshot in.
+        Returns the tail state it covers, or None when not forced and no snapshot is due
+        yet, or when another process swapped in a snapshot first.
+        """
+        with self._locked():
+            tail = self._recover()
+            if not force and not self._snapshot_due(tail):
+                return None
+            self._sync_index(tail)
+            header = self._read_snapshot_header()
+            generation = header["generation"] if header else 0
+            index_path = self._index_path(generation)
+            covered = os.path.getsize(index_path)
+            # Opened under the lock so the merge reads the snapshot this generation follows
+            previous = open(self._path("snapshot"), "rb") if header else None
+        tmp = self._path(f"snapshot.{os.getpid()}")
+        try:
+            self._merge_snapshot(tmp, previous, index_path, covered, tail, generation + 1)
+        finally:
+            if previous:
+                previous.close()
+        with self._locked():
+            current = self._read_snapshot_header()
+            if (current["generation"] if current else 0) != generation:
+                os.remove(tmp)
+                log.info("Discarding ledger snapshot at block %d; another process wrote one first", tail["index"])
+                return None
+            with open(index_path, "rb") as f:
+                f.seek(covered)
+                carried = f.read()
+            next_tmp = self._index_path(generation + 1) + f".{os.getpid()}"
+            with open(next_tmp, "wb") as f:
+                f.write(carried[:len(carried) - len(carried) % VOTER_INDEX.size])
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(next_tmp, self._index_path(generation + 1))
+            os.replace(tmp, self._path("snapshot"))
+            dir_fd = os.open(self.directory, os.O_RDONLY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
+            # The folded generation, and any left behind by a crash before this point
+            for name in os.listdir(self.directory):
+                parts = name.split(".")
+                if parts[0] == "voters" and parts[-1] == "idx" and name != f"voters.{generation + 1}.idx" \
+                        and (len(parts) == 2 or (len(parts) == 3 and parts[1].isdigit())):
+                    os.remove(self._path(name))
+        return tail
+
+    def _merge_snapshot(self, path: str, previous, index_path: str, covered: int, tail: dict, generation: int):
+        """
+        Write the previous snapshot's entries merged with the first covered bytes of the index
+        generation. Entries are big-endian unsigned fields, so their byte order is their
+        (voter_id, index) order: only the suffix is sorted, and the runs of the previous
+        snapshot between suffix entries are copied as slices instead of entry by entry.
+        """
+        size = VOTER_INDEX.size
+        with open(index_path, "rb") as f:
+            data = f.read(covered - covered % size)
+        suffix = sorted(data[i:i + size] for i in range(0, len(data), size))
+        entries, count = b"", 0
+        if previous is not None and os.fstat(previous.fileno()).st_size > SNAPSHOT.size:
+            mapped = mmap.mmap(previous.fileno(), 0, access=mmap.ACCESS_READ)
+            count = SNAPSHOT.unpack_from(mapped)[7]
+            entries = memoryview(mapped)[SNAPSHOT.size:SNAPSHOT.size + count * size]
+        try:
+            with open(path, "wb") as out:
+                out.write(bytes(SNAPSHOT.size))
+                pos = 0
+                for entry in suffix:
+                    lo, hi = pos, count
+                    while lo < hi:
+                        mid = (lo + hi) // 2
+                        if bytes(entries[mid * size:(mid + 1) * size]) < entry:
+                            lo = mid + 1
+                        else:
+                            hi = mid
+                    out.write(entries[pos * size:lo * size])
+                    out.write(entry)
+                    pos = lo
+                out.write(entries[pos * size:])
+                out.seek(0)
+                out.write(SNAPSHOT.pack(SNAPSHOT_MAGIC, tail["segment"], tail["offset"], tail["index"],
+                                        tail["hash"], tail["seal_root"], generation, count + len(suffix)))
+                out.flush()
+                os.fsync(out.fileno())
+        finally:
+            if isinstance(entries, memoryview):
+                entries.release()
+                mapped.close()
+
+    # --------------------------------------------------------------------------
+    # Group commit
+    # --------------------------------------------------------------------------
+    def append(self, payload: dict, kind: int = RECORD_VOTE, timeout: float = 30.0) -> dict:
+        """Queue a block and wait until the batch holding it has been fsynced."""
+        entry = {"kind": kind, "payload": payload, "done": threading.Event(), "block": None, "error": None}
+        with self._cond:
+            self._ensure_writer()
+            self._pending.append(entry)
+            self._cond.notify_all()
+        if not entry["done"].wait(timeout):
+            raise TimeoutError("Timed out waiting for the ledger commit")
+        if entry["error"] is not None:
+            raise entry["error"]
+        return entry["block"]
+
+    def _ensure_writer(self):
+        # Threads do not survive a fork, so each worker process starts its own writer
+        if self._writer is None or self._writer_pid != os.getpid():
+            self._pending = []
+            self._writer_pid = os.getpid()
+            self._writer = threading.Thread(target=self._run_writer, name="ledger-writer", daemon=True)
+            self._writer.start()
+
+    def _run_writer(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                # Give concurrent voters commit_interval to join this batch
+                deadline = time.monotonic() + self.commit_interval
+                while len(self._pending) < self.commit_batch:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                batch, self._pending = self._pending[:self.commit_batch], self._pending[self.commit_batch:]
+            try:
+                blocks = self._commit([(entry["kind"], entry["payload"]) for entry in batch])
+                for entry, block in zip(batch, blocks):
+                    entry["block"] = block
+            except Exception as e:
+                log.error("Ledger commit failed: %s", e)
+                for entry in batch:
+                    entry["error"] = e
+            for entry in batch:
+                entry["done"].set()
+            try:
+                if self.snapshot_interval and self._snapshot_due(self.read_tail()):
+                    self._start_snapshot()
+            except Exception as e:
+                log.error("Ledger snapshot failed: %s", e)
+
+    def _start_snapshot(self):
+        # Snapshots are built off the writer thread so this worker keeps committing meanwhile
+        if self._snapshotter is not None and self._snapshotter.is_alive():
+            return
+        self._snapshotter = threading.Thread(target=self._run_snapshot, name="ledger-snapshot", daemon=True)
+        self._snapshotter.start()
+
+    def _run_snapshot(self):
+        try:
+            self.write_snapshot(force=False)
+        except Exception as e:
+            log.error("Ledger snapshot failed: %s", e)
+
+    @contextlib.contextmanager
+    def _locked(self):
+        with open(self._path("lock"), "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _commit(self, batch: list) -> list:
+        with self._locked():
+            tail = self._recover()
+            segment, offset = tail["segment"], tail["offset"]
+            if offset >= self.segment_size:
+                # Close out the full segment at its committed end before rolling over
+                with open(self.segment_path(segment), "r+b") as f:
+                    f.truncate(offset)
+                segment, offset = segment + 1, 0
+            prev_hash, index = tail["hash"], tail["index"]
+            records, blocks = [], []
+            position = offset
+
+            def add(kind, payload):
+                nonlocal index, prev_hash, position
+                index += 1
+                data = json.dumps(payload, separators=(",", ":"), sort_keys=True).encode("utf-8")
+                timestamp = time.time()
+                record, block_hash = encode_record(kind, index, timestamp, prev_hash, data)
+                fields = (LEDGER_MAGIC, kind, len(data), index, timestamp, prev_hash, block_hash)
+                block = make_block(fields, data, segment, position, position + len(record))
+                records.append(record)
+                prev_hash = block_hash
+                position += len(record)
+                return block
+
+            for kind, payload in batch:
+                blocks.append(add(kind, payload))
+            seal_root = tail["seal_root"]
+            vote_hashes = [block["vote_hash"] for block in blocks if block["kind"] == RECORD_VOTE and block.get("vote_hash")]
+            if vote_hashes:
+                root = merkle_root(vote_hashes)
+                add(RECORD_SEAL, {
+                    "first_index": blocks[0]["index"],
+                    "last_index": blocks[-1]["index"],
+                    "count": len(vote_hashes),
+                    "start": offset,
+                    "root": root.hex(),
+                    "prev_root": seal_root.hex()
+                })
+                seal_root = root
+            fd = os.open(self.segment_path(segment), os.O_RDWR | os.O_CREAT, 0o644)
+            with os.fdopen(fd, "r+b") as f:
+                # Anything past the committed tail is a torn batch from a crashed writer
+                f.truncate(offset)
+                f.seek(offset)
+                f.write(b"".join(records))
+                f.flush()
+                os.fsync(f.fileno())
+            if offset == 0:
+                dir_fd = os.open(self.directory, os.O_RDONLY)
+                try:
+                    os.fsync(dir_fd)
+                finally:
+                    os.close(dir_fd)
+            self._sync_index(tail, blocks)
+            self._write_tail({"segment": segment, "offset": position, "index": index, "hash": prev_hash, "seal_root": seal_root})
+            self.stats["appends"] += len(batch)
+            self.stats["commits"] += 1
+            return blocks
+
+    # --------------------------------------------------------------------------
+    # Verification
+    # --------------------------------------------------------------------------
+    def load_checkpoint(self, key: bytes) -> dict:
+        """The last verified position, or None when there is none or its signature is wrong."""
+        try:
+            with open(self._path("checkpoint.json")) as f:
+                checkpoint = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if not hmac.compare_digest(checkpoint.get("signature", ""), sign_checkpoint(checkpoint, key)):
+            log.error("Ledger checkpoint signature is invalid; ignoring it")
+            return None
+        return checkpoint
+
+    def save_checkpoint(self, checkpoint: dict, key: bytes):
+        checkpoint = dict(checkpoint, signature=sign_checkpoint(checkpoint, key))
+        tmp = self._path(f"checkpoint.json.{os.getpid()}")
+        with open(tmp, "w") as f:
+            json.dump(checkpoint, f, indent=2)
+        os.replace(tmp, self._path("checkpoint.json"))
+
+    def verify(self, checkpoint: dict = None, workers: int = None, on_votes=None) -> dict:
+        """
+        Verify the ledger from checkpoint (or genesis) to the current tail with one worker
+        process per segment, then stitch the hash and seal chains across segment borders.
+        Each segment's votes, as (vote_hash, voter_id, election_id, candidate_id, index)
+        tuples, are handed to on_votes in ledger order and then dropped. Only about two
+        segments per worker are in flight at once, so memory does not grow with the ledger.
+        """
+        stop = self.read_tail()
+        start = {"segment": 0, "offset": 0, "index": 0, "hash": GENESIS_HASH.hex(), "seal_root": GENESIS_HASH.hex()}
+        if checkpoint:
+            start = {k: checkpoint[k] for k in start}
+        tasks = [(seg, start["offset"] if seg == start["segment"] else 0, stop["offset"] if seg == stop["segment"] else None)
+                 for seg in self.segments() if start["segment"] <= seg <= stop["segment"]]
+        workers = workers or os.cpu_count() or 1
+        state = {"errors": [], "votes": 0, "blocks": 0,
+                 "index": start["index"], "hash": start["hash"], "seal_root": start["seal_root"]}
+
+        def stitch(result):
+            state["errors"].extend(result["errors"])
+            state["votes"] += len(result["votes"])
+            state["blocks"] += result["blocks"]
+            if on_votes is not None and result["votes"]:
+                on_votes(result["votes"])
+            if result["first"] is None:
+                return
+            if result["first"]["index"] != state["index"] + 1 or result["first"]["prev_hash"] != state["hash"]:
+                state["errors"].append(f"Segment {result['segment']} does not link to block {state['index']}")
+            if result["first_prev_root"] is not None and result["first_prev_root"] != state["seal_root"]:
+                state["errors"].append(f"First seal in segment {result['segment']} does not chain to the previous seal")
+            state["index"], state["hash"] = result["last"]["index"], result["last"]["hash"]
+            state["seal_root"] = result["seal_root"] or state["seal_root"]
+
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+            window = deque()
+            for task in tasks:
+                window.append(pool.submit(verify_segment, self.directory, *task))
+                if len(window) >= 2 * workers:
+                    stitch(window.popleft().result())
+            while window:
+                stitch(window.popleft().result())
+        index, block_hash, seal_root = state["index"], state["hash"], state["seal_root"]
+        if index != stop["index"] or block_hash != stop["hash"].hex() or seal_root != stop["seal_root"].hex():
+            state["errors"].append(f"Verified chain ends at block {index}, the tail pointer at block {stop['index']}")
+        return {
+            "start": start,
+            "tail": {"segment": stop["segment"], "offset": stop["offset"], "index": index,
+                     "hash": block_hash, "seal_root": seal_root},
+            "blocks": state["blocks"],
+            "votes": state["votes"],
+            "errors": state["errors"]
+        }
+
+    def counters(self) -> dict:
+        tail = self.read_tail()
+        return dict(self.stats, index=tail["index"], head=tail["hash"].hex(), seal_root=tail["seal_root"].hex(),
+                    segments=len(self.segments()))
@@ -0,0 +1,125 @@
+"""
+JSON line logging to a file shared by every worker process.
+
+RotatingJSONLogHandler rotates LOG_FILE on size or age, gzips what it rotates out and
+coordinates the workers writing to the same file through an flock on LOG_FILE.lock, so
+no line is lost or written twice across a rotation.
+"""
+import os
+import json
+import gzip
+import time
+import fcntl
+import shutil
+import logging
+from logging.handlers import RotatingFileHandler
+
+class JSONLogFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "thread": record.threadName,
+            # QueueHandler has already folded any traceback into the message
+            "message": record.getMessage()
+        }
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class RotatingJSONLogHandler(RotatingFileHandler):
+    """
+    RotatingFileHandler that also rotates on age, gzips the files it rotates out, and is safe
+    to share between worker processes. Every write holds a shared flock on LOG_FILE.lock and
+    a rotation holds it exclusively, so no process writes into a file while it is being
+    rotated. The lock file also records when the last rotation happened. A writer that finds
+    LOG_FILE replaced reopens it, and a rotation that another process has already done is
+    skipped.
+    """
+    def __init__(self, filename: str, max_bytes: int, backup_count: int, rotate_seconds: int):
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8", delay=True)
+        self.rotate_seconds = rotate_seconds
+        self.lock_path = self.baseFilename + ".lock"
+        self._lock_fd = None
+        self._lock_pid = None
+        self.namer = lambda name: name + ".gz"
+        self.rotator = self._gzip_rotator
+        self.rollover_at = self._last_rotation() + rotate_seconds
+
+    @staticmethod
+    def _gzip_rotator(source: str, dest: str):
+        with open(source, "rb") as src, gzip.open(dest, "wb") as dst:
+            shutil.copyfileobj(src, dst)
+        os.remove(source)
+
+    def _lock_file(self) -> int:
+        # flock belongs to the open file description, which a forked child shares with its parent
+        if self._lock_fd is None or self._lock_pid != os.getpid():
+            self._lock_fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+            self._lock_pid = os.getpid()
+        return self._lock_fd
+
+    def _last_rotation(self) -> float:
+        try:
+            fd = self._lock_file()
+            stamp = os.pread(fd, 32, 0)
+            if not stamp:
+                # First process to use this log file starts the age clock
+                stamp = repr(time.time()).encode()
+                os.pwrite(fd, stamp, 0)
+            return float(stamp)
+        except (OSError, ValueError):
+            return time.time()
+
+    def _reopen_if_replaced(self):
+        if self.stream is None:
+            return
+        try:
+            current = os.stat(self.baseFilename)
+            opened = os.fstat(self.stream.fileno())
+            replaced = (current.st_dev, current.st_ino) != (opened.st_dev, opened.st_ino)
+        except FileNotFoundError:
+            replaced = True
+        if replaced:
+            self.stream.close()
+            self.stream = None
+
+    def _rollover_due(self) -> bool:
+        if self.rotate_seconds and time.time() >= self._last_rotation() + self.rotate_seconds:
+            return True
+        try:
+            return bool(self.maxBytes) and os.stat(self.baseFilename).st_size >= self.maxBytes
+        except FileNotFoundError:
+            return False
+
+    def shouldRollover(self, record):
+        if self.rotate_seconds and time.time() >= self.rollover_at:
+            return True
+        return super().shouldRollover(record)
+
+    def doRollover(self):
+        fd = self._lock_file()
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            self._reopen_if_replaced()
+            # Another process may have rotated while we waited for the lock
+            if self._rollover_due():
+                super().doRollover()
+                os.ftruncate(fd, 0)
+                os.pwrite(fd, repr(time.time()).encode(), 0)
+            self.rollover_at = self._last_rotation() + self.rotate_seconds
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+
+    def emit(self, record):
+        try:
+            if self.shouldRollover(record):
+                self.doRollover()
+            fd = self._lock_file()
+            fcntl.flock(fd, fcntl.LOCK_SH)
+            try:
+                self._reopen_if_replaced()
+                logging.FileHandler.emit(self, record)
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+        except Exception:
+            self.handleError(record)
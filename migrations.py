@@ -0,0 +1,127 @@
+"""
+Schema migration runner.
+
+A migration is a (version, description, step) tuple, where step is a callable taking a
+cursor or a list of SQL statements and such callables. apply_migrations() applies the
+ones newer than the schema_version table on a single connection, serialised across
+deploys with a named MySQL lock. MySQL commits every DDL statement on its own, so a step
+can be left half done by a failure: steps must check what is already there, and a failed
+run is resumed by running the migrations again.
+"""
+import re
+import time
+import logging
+
+log = logging.getLogger("evoting.db")
+
+MIGRATION_LOCK = "evoting_schema_migrations"
+
+def split_sql_statements(script: str) -> list:
+    """Split a SQL script on top-level semicolons, dropping comments and database selection."""
+    statements, current = [], []
+    quote = None
+    i = 0
+    while i < len(script):
+        ch = script[i]
+        if quote:
+            current.append(ch)
+            if ch == "\\" and i + 1 < len(script):
+                current.append(script[i + 1])
+                i += 1
+            elif ch == quote:
+                quote = None
+        elif ch in ("'", '"', "`"):
+            quote = ch
+            current.append(ch)
+        elif script.startswith("--", i):
+            newline = script.find("\n", i)
+            i = len(script) if newline == -1 else newline
+            continue
+        elif ch == ";":
+            statements.append("".join(current).strip())
+            current = []
+        else:
+            current.append(ch)
+        i += 1
+    statements.append("".join(current).strip())
+    # The target database comes from the connection settings, not from the script
+    return [s for s in statements if s and not re.match(r"(?i)^(CREATE\s+DATABASE|USE)\b", s)]
+
+def table_exists(cur, table: str) -> bool:
+    cur.execute("SELECT COUNT(*) FROM information_schema.TABLES WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s", (table,))
+    return cur.fetchone()[0] > 0
+
+def index_columns(cur, table: str, index: str) -> list:
+    """Columns of an index in order, or [] when the table has no index of that name."""
+    cur.execute("""
+        SELECT COLUMN_NAME FROM information_schema.STATISTICS
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND INDEX_NAME = %s ORDER BY SEQ_IN_INDEX
+    """, (table, index))
+    return [row[0] for row in cur.fetchall()]
+
+def add_index(cur, table: str, definition: str):
+    """ALTER TABLE ... ADD <definition> unless an index of that name exists (DDL cannot be rolled back)."""
+    name = re.search(r"(?:KEY|INDEX)\s+`?(\w+)", definition).group(1)
+    if not index_columns(cur, table, name):
+        cur.execute(f"ALTER TABLE {table} ADD {definition}")
+
+def get_schema_version(cur) -> int:
+    cur.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version")
+    return cur.fetchone()[0]
+
+def apply_migrations(conn, migrations: list, echo=log.info) -> list:
+    """Apply pending migrations in order and return the versions applied. Closes conn."""
+    applied = []
+    cur = conn.cursor()
+    try:
+        # Serialise concurrent deploys; the second runner waits, then finds nothing to do
+        cur.execute("SELECT GET_LOCK(%s, 300)", (MIGRATION_LOCK,))
+        if cur.fetchone()[0] != 1:
+            raise RuntimeError("Timed out waiting for the migration lock.")
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INT PRIMARY KEY,
+                description VARCHAR(255) NOT NULL,
+                applied_at DATETIME DEFAULT CURRENT_TIMESTAMP
+            ) ENGINE=InnoDB
+        """)
+        current = get_schema_version(cur)
+        if current == 0 and table_exists(cur, "voters"):
+            # Database set up by hand from sql.sql before the runner existed: adopt it as the baseline
+            cur.execute("INSERT INTO schema_version (version, description) VALUES (%s, %s)", (1, migrations[0][1] + " (adopted)"))
+            conn.commit()
+            current = 1
+            echo("Existing schema adopted as version 1.")
+        for version, description, migrate in migrations:
+            if version <= current:
+                continue
+            started = time.perf_counter()
+            if callable(migrate):
+                migrate(cur)
+            else:
+                for statement in migrate:
+                    if callable(statement):
+                        statement(cur)
+                    else:
+                        cur.execute(statement)
+            cur.execute("INSERT INTO schema_version (version, description) VALUES (%s, %s)", (version, description))
+            conn.commit()
+            applied.append(version)
+            echo(f"Applied migration {version}: {description} ({time.perf_counter() - started:.2f}s)")
+        return applied
+    except Exception:
+        # Only undoes DML of the failed step; its DDL is already committed and is skipped on the next run
+        try:
+            conn.rollback()
+        except Exception as e:
+            log.error("Rollback after a failed migration failed: %s", e)
+        raise
+    finally:
+        try:
+            cur.execute("SELECT RELEASE_LOCK(%s)", (MIGRATION_LOCK,))
+            cur.fetchall()
+        except Exception as e:
+            # MySQL frees the lock with the session, so a broken connection needs nothing more
+            log.warning("Could not release the migration lock: %s", e)
+        cur.close()
+        conn.close()
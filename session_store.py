@@ -0,0 +1,163 @@
+"""
+Server-side session storage.
+
+The session cookie only carries a signed session id; the session itself lives in a store:
+
+    SQLiteSessionStore  embedded store for single-node deployments, swept by a thread
+    RedisSessionStore   shared store for multi-node deployments; Redis expires keys itself.
+                        Any client with get/set(ex=)/delete works, e.g. a local stand-in
+
+ServerSideSessionInterface creates its store through a factory the first time a process
+touches a session, so importing the app (CLI commands, worker processes) opens nothing.
+"""
+import os
+import time
+import secrets
+import sqlite3
+import logging
+import threading
+
+from flask.sessions import SessionInterface, SessionMixin
+from flask.json.tag import TaggedJSONSerializer
+from werkzeug.datastructures import CallbackDict
+from itsdangerous import Signer, BadSignature
+
+log = logging.getLogger("evoting.session")
+
+class SQLiteSessionStore:
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        conn = self._connection()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("CREATE TABLE IF NOT EXISTS sessions (sid TEXT PRIMARY KEY, data BLOB NOT NULL, expires_at REAL NOT NULL)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_sessions_expires_at ON sessions (expires_at)")
+
+    def _connection(self):
+        # sqlite3 connections must not be shared across threads
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, sid: str):
+        row = self._connection().execute("SELECT data FROM sessions WHERE sid = ? AND expires_at > ?", (sid, time.time())).fetchone()
+        return row[0] if row else None
+
+    def set(self, sid: str, data: bytes, ttl: float):
+        self._connection().execute("INSERT OR REPLACE INTO sessions (sid, data, expires_at) VALUES (?, ?, ?)", (sid, data, time.time() + ttl))
+
+    def delete(self, sid: str):
+        self._connection().execute("DELETE FROM sessions WHERE sid = ?", (sid,))
+
+    def sweep(self) -> int:
+        return self._connection().execute("DELETE FROM sessions WHERE expires_at <= ?", (time.time(),)).rowcount
+
+class RedisSessionStore:
+    def __init__(self, url: str, prefix: str = "evoting:session:", client=None):
+        if client is None:
+            import redis  # only needed for multi-node deployments
+            client = redis.Redis.from_url(url)
+        self.client = client
+        self.prefix = prefix
+
+    def get(self, sid: str):
+        return self.client.get(self.prefix + sid)
+
+    def set(self, sid: str, data: bytes, ttl: float):
+        self.client.set(self.prefix + sid, data, ex=max(1, int(ttl)))
+
+    def delete(self, sid: str):
+        self.client.delete(self.prefix + sid)
+
+    def sweep(self) -> int:
+        return 0
+
+class ServerSideSession(CallbackDict, SessionMixin):
+    def __init__(self, initial=None, sid=None, new=False):
+        def on_update(self):
+            self.modified = True
+        CallbackDict.__init__(self, initial, on_update)
+        self.sid = sid
+        self.new = new
+        self.modified = False
+
+class ServerSideSessionInterface(SessionInterface):
+    """Keeps session data in a store; the cookie only carries a signed session id."""
+    serializer = TaggedJSONSerializer()
+
+    def __init__(self, store_factory, sweep_interval: int = None):
+        self.store_factory = store_factory
+        self.sweep_interval = sweep_interval
+        self._store = None
+        self._store_pid = None
+        self._store_lock = threading.Lock()
+
+    @property
+    def store(self):
+        # Created per process: a sweeper thread started before a fork does not survive it
+        if self._store_pid != os.getpid():
+            with self._store_lock:
+                if self._store_pid != os.getpid():
+                    self._store = self.store_factory()
+                    if self.sweep_interval:
+                        threading.Thread(target=session_sweeper, args=(self._store, self.sweep_interval),
+                                         daemon=True, name="session-sweeper").start()
+                    self._store_pid = os.getpid()
+        return self._store
+
+    def _signer(self, app):
+        return Signer(app.secret_key, salt="evoting-session")
+
+    def open_session(self, app, request):
+        cookie = request.cookies.get(self.get_cookie_name(app))
+        if cookie:
+            try:
+                sid = self._signer(app).unsign(cookie).decode()
+                data = self.store.get(sid)
+                if data is not None:
+                    return ServerSideSession(self.serializer.loads(data.decode() if isinstance(data, bytes) else data), sid=sid)
+            except BadSignature:
+                pass
+            except Exception as e:
+                log.error("Error loading session: %s", e)
+        return ServerSideSession(sid=secrets.token_urlsafe(32), new=True)
+
+    def save_session(self, app, session, response):
+        if getattr(session, "over_budget", False):
+            # enforce_session_budget failed the request; the stored session keeps its last good state
+            return
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        if not session:
+            if session.modified:
+                self.store.delete(session.sid)
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+        if not self.should_set_cookie(app, session):
+            return
+        ttl = app.permanent_session_lifetime.total_seconds()
+        self.store.set(session.sid, self.serializer.dumps(dict(session)).encode(), ttl)
+        response.set_cookie(
+            name,
+            self._signer(app).sign(session.sid).decode(),
+            expires=self.get_expiration_time(app, session),
+            httponly=self.get_cookie_httponly(app),
+            secure=self.get_cookie_secure(app),
+            samesite=self.get_cookie_samesite(app),
+            domain=domain,
+            path=path
+        )
+
+def session_sweeper(store, interval: int):
+    while True:
+        time.sleep(interval)
+        try:
+            removed = store.sweep()
+            if removed:
+                log.debug("Session sweeper removed %d expired sessions.", removed)
+        except Exception as e:
+            log.error("Session sweep failed: %s", e)
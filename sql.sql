@@ -62,7 +62,7 @@ CREATE TABLE IF NOT EXISTS candidates (
 CREATE TABLE IF NOT EXISTS admins (
     admin_id INT AUTO_INCREMENT PRIMARY KEY,
     admin_username VARCHAR(255) NOT NULL UNIQUE,
-    password_hash VARCHAR(255) NOT NULL,
+    Password VARCHAR(255) NOT NULL,
     registered_at DATETIME DEFAULT CURRENT_TIMESTAMP
 ) ENGINE = InnoDB;
 
@@ -77,29 +77,45 @@ CREATE TABLE IF NOT EXISTS elections (
 ) ENGINE = InnoDB;
 
 -- 2.8. Create the "votes" table that references voters, candidates, elections, and constituencies.
+--    The table is RANGE partitioned by election_id so that results queries for one election only
+--    read that election's partition and a completed election can be archived (EXCHANGE PARTITION)
+--    or pruned (DROP PARTITION) in constant time. MySQL does not allow foreign keys on partitioned
+--    tables, and every unique key must include election_id, hence the composite primary key.
+--    New elections get their own partition with `flask add-election-partition <election_id>`;
+--    until then their votes land in p_future.
 CREATE TABLE IF NOT EXISTS votes (
-    vote_id INT AUTO_INCREMENT PRIMARY KEY,
+    vote_id INT AUTO_INCREMENT,
     voter_id INT NOT NULL,
     candidate_id INT NOT NULL,
     election_id INT NOT NULL,
     constituency_id INT NOT NULL,
     vote_timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
     vote_hash VARCHAR(255) NOT NULL,
-    FOREIGN KEY (voter_id) REFERENCES voters(voter_id) ON DELETE CASCADE,
-    FOREIGN KEY (candidate_id) REFERENCES candidates(candidate_id) ON DELETE CASCADE,
-    FOREIGN KEY (election_id) REFERENCES elections(election_id) ON DELETE CASCADE,
-    FOREIGN KEY (constituency_id) REFERENCES constituencies(constituency_id) ON DELETE CASCADE
-) ENGINE = InnoDB;
-
--- 2.9. Create the "audit_logs" table that references voters.
+    PRIMARY KEY (vote_id, election_id),
+    UNIQUE KEY uq_votes_voter_election (voter_id, election_id),
+    KEY idx_votes_tally (election_id, constituency_id, candidate_id)
+) ENGINE = InnoDB
+PARTITION BY RANGE (election_id) (
+    PARTITION p_future VALUES LESS THAN MAXVALUE
+);
+
+-- 2.9. Create the "audit_logs" table.
+--    The table is RANGE partitioned by month on log_timestamp so inserts and indexes stay the same
+--    size across election cycles and old months are archived and dropped in constant time with
+--    `flask rotate-audit-logs`. As with votes, partitioning rules out the foreign key to voters
+--    and puts log_timestamp in the primary key. Monthly partitions are split off p_future by
+--    the migrations and by rotate-audit-logs.
 CREATE TABLE IF NOT EXISTS audit_logs (
-    log_id INT AUTO_INCREMENT PRIMARY KEY,
+    log_id INT AUTO_INCREMENT,
     user_id INT,
     action VARCHAR(255) NOT NULL,
     details TEXT,
-    log_timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
-    FOREIGN KEY (user_id) REFERENCES voters(voter_id) ON DELETE SET NULL
-) ENGINE = InnoDB;
+    log_timestamp DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (log_id, log_timestamp)
+) ENGINE = InnoDB
+PARTITION BY RANGE COLUMNS (log_timestamp) (
+    PARTITION p_future VALUES LESS THAN (MAXVALUE)
+);
 
 -- Step 3: Insert Sample Data for Geographic Hierarchy
 
@@ -821,7 +837,7 @@ INSERT INTO candidates (candidate_name, party, manifesto, constituency_id) VALUE
 ('Ishaan - Pathalgaon (ST)', 'Goa Forward Party (GFP)', 'Promoting rural infrastructure and education.', 67),
 ('Hemant - Pathalgaon (ST)', 'Revolutionary Goans Party (RGP)', 'Enhancing healthcare and public services.', 67);
 
-INSERT INTO admins (admin_username, password) VALUES
-(Debadyuti Dey', 'DEBA4400'),
+INSERT INTO admins (admin_username, Password) VALUES
+('Debadyuti Dey', 'DEBA4400'),
 ('Soumyajit Nandy', 'Soumo123'),
 ('Rajdip Routh', 'RajLovesMisty');
\ No newline at end of file
@@ -0,0 +1,177 @@
+import hashlib
+import os
+
+import pytest
+
+from ledger import VoteLedger, merkle_root, verify_merkle_proof
+
+def vote(voter_id: int, election_id: int = 1, candidate_id: int = 1) -> dict:
+    return {"voter_id": voter_id, "election_id": election_id, "candidate_id": candidate_id,
+            "vote_hash": hashlib.sha256(f"{election_id}:{voter_id}".encode()).hexdigest()}
+
+@pytest.fixture
+def ledger(tmp_path):
+    return VoteLedger(str(tmp_path / "ledger"), commit_interval=0)
+
+def commit(ledger, voter_ids):
+    return ledger._commit([(1, vote(voter_id)) for voter_id in voter_ids])
+
+def test_round_trip(ledger):
+    commit(ledger, [1, 2])
+    commit(ledger, [3])
+    reopened = VoteLedger(ledger.directory)
+    blocks = list(reopened.blocks())
+    assert [b["voter_id"] for b in blocks if b["kind"] == 1] == [1, 2, 3]
+    assert reopened.voter_blocks(2)[0]["vote_hash"] == vote(2)["vote_hash"]
+    assert reopened.verify(workers=1)["errors"] == []
+
+def test_blocks_committed_after_the_tail_pointer_are_recovered(ledger):
+    commit(ledger, [1])
+    with open(ledger._path("tail"), "rb") as f:
+        stale_tail = f.read()
+    commit(ledger, [2, 3])
+    # Crash after the segment fsync but before the tail pointer was replaced
+    with open(ledger._path("tail"), "wb") as f:
+        f.write(stale_tail)
+    reopened = VoteLedger(ledger.directory)
+    commit(reopened, [4])
+    assert reopened.stats["recovered"] == 3  # two votes and their seal
+    assert [b["voter_id"] for b in reopened.blocks() if b["kind"] == 1] == [1, 2, 3, 4]
+    assert reopened.verify(workers=1)["errors"] == []
+
+def test_torn_batch_is_truncated_by_the_next_commit(ledger):
+    commit(ledger, [1])
+    tail = ledger.read_tail()
+    # Crash part way through writing the next batch
+    with open(ledger.segment_path(tail["segment"]), "ab") as f:
+        f.write(b"EVL1\x01 torn")
+    reopened = VoteLedger(ledger.directory)
+    assert reopened._recover()["index"] == tail["index"]
+    commit(reopened, [2])
+    assert [b["voter_id"] for b in reopened.blocks() if b["kind"] == 1] == [1, 2]
+    assert reopened.verify(workers=1)["errors"] == []
+
+def test_verify_detects_a_modified_block(ledger):
+    commit(ledger, [1, 2])
+    block = next(ledger.blocks())
+    with open(ledger.segment_path(0), "r+b") as f:
+        f.seek(block["end"] - 10)
+        f.write(b"X")
+    assert ledger.verify(workers=1)["errors"]
+
+def test_missing_tail_pointer_is_rebuilt_from_the_segments(ledger):
+    commit(ledger, [1, 2])
+    head = ledger.read_tail()
+    os.remove(ledger._path("tail"))
+    reopened = VoteLedger(ledger.directory)
+    with reopened._locked():
+        assert reopened._recover() == head
+
+def test_chain_continues_across_segments(tmp_path):
+    ledger = VoteLedger(str(tmp_path / "ledger"), segment_size=512)
+    for voter_id in range(1, 9):
+        commit(ledger, [voter_id])
+    assert len(ledger.segments()) > 1
+    result = ledger.verify(workers=2)
+    assert result["errors"] == []
+    assert result["votes"] == 8
+
+@pytest.mark.parametrize("batch_size", [1, 2, 5, 8])
+def test_inclusion_proofs_verify_against_the_seal_root(ledger, batch_size):
+    voter_ids = list(range(1, batch_size + 1))
+    commit(ledger, voter_ids)
+    for voter_id in voter_ids:
+        vote_hash = vote(voter_id)["vote_hash"]
+        proof = ledger.inclusion_proof(voter_id, vote_hash)
+        assert proof["leaf_count"] == batch_size
+        assert proof["merkle_root"] == merkle_root([vote(v)["vote_hash"] for v in voter_ids]).hex()
+        assert verify_merkle_proof(vote_hash, proof["proof"], proof["merkle_root"])
+
+def test_proof_does_not_verify_another_vote_or_root(ledger):
+    commit(ledger, [1, 2, 3])
+    commit(ledger, [4])
+    proof = ledger.inclusion_proof(2, vote(2)["vote_hash"])
+    other_root = ledger.inclusion_proof(4, vote(4)["vote_hash"])["merkle_root"]
+    assert not verify_merkle_proof(vote(3)["vote_hash"], proof["proof"], proof["merkle_root"])
+    assert not verify_merkle_proof(vote(2)["vote_hash"], proof["proof"], other_root)
+
+def test_seals_chain_across_commits(ledger):
+    commit(ledger, [1])
+    commit(ledger, [2])
+    first = ledger.inclusion_proof(1, vote(1)["vote_hash"])
+    second = ledger.inclusion_proof(2, vote(2)["vote_hash"])
+    assert second["seal"]["prev_root"] == first["merkle_root"]
+
+def test_no_proof_for_an_unknown_vote(ledger):
+    commit(ledger, [1])
+    assert ledger.inclusion_proof(1, vote(2)["vote_hash"]) is None
+    assert ledger.inclusion_proof(2, vote(2)["vote_hash"]) is None
+
+def receipts(ledger, voter_id):
+    return [(b["voter_id"], b["vote_hash"]) for b in ledger.voter_blocks(voter_id)]
+
+def test_snapshot_plus_suffix_replay(ledger):
+    commit(ledger, [1, 2, 3])
+    ledger.write_snapshot()
+    ledger._commit([(1, vote(2, election_id=2)), (1, vote(4))])
+    reopened = VoteLedger(ledger.directory)
+    assert receipts(reopened, 2) == [(2, vote(2)["vote_hash"]), (2, vote(2, election_id=2)["vote_hash"])]
+    assert receipts(reopened, 4) == [(4, vote(4)["vote_hash"])]
+    assert reopened._snapshot["count"] == 3
+    assert len(reopened._voter_index) == 2  # only the suffix was replayed into memory
+
+def test_snapshots_rotate_index_generations(ledger):
+    for round_ in range(1, 4):
+        commit(ledger, [round_, 100])
+        assert ledger.write_snapshot()["index"] == ledger.read_tail()["index"]
+        indexes = sorted(name for name in os.listdir(ledger.directory) if name.endswith(".idx"))
+        assert indexes == [f"voters.{round_}.idx"]
+    reopened = VoteLedger(ledger.directory)
+    assert len(reopened.voter_blocks(100)) == 3
+    assert [len(reopened.voter_blocks(v)) for v in (1, 2, 3)] == [1, 1, 1]
+
+def test_reader_follows_a_snapshot_taken_by_another_instance(ledger):
+    commit(ledger, [1])
+    reader = VoteLedger(ledger.directory)
+    assert len(reader.voter_blocks(1)) == 1
+    ledger.write_snapshot()
+    commit(ledger, [1])
+    ledger.write_snapshot()
+    commit(ledger, [2])
+    assert len(reader.voter_blocks(1)) == 2
+    assert len(reader.voter_blocks(2)) == 1
+
+def test_commits_during_the_merge_carry_into_the_next_generation(ledger, monkeypatch):
+    commit(ledger, [1, 2])
+    merge = VoteLedger._merge_snapshot
+
+    def merge_while_committing(self, *args):
+        commit(VoteLedger(self.directory), [2, 3])
+        merge(self, *args)
+
+    monkeypatch.setattr(VoteLedger, "_merge_snapshot", merge_while_committing)
+    tail = ledger.write_snapshot()
+    reopened = VoteLedger(ledger.directory)
+    assert reopened._read_snapshot_header()["index"] == tail["index"]
+    assert reopened.read_tail()["index"] > tail["index"]
+    assert len(reopened.voter_blocks(2)) == 2
+    assert len(reopened.voter_blocks(3)) == 1
+
+def test_snapshot_is_taken_automatically(tmp_path):
+    ledger = VoteLedger(str(tmp_path / "ledger"), commit_interval=0, snapshot_interval=4)
+    for voter_id in range(1, 6):
+        ledger.append(vote(voter_id))
+    ledger._snapshotter.join(5)
+    assert ledger._read_snapshot_header() is not None
+    assert all(len(VoteLedger(ledger.directory).voter_blocks(v)) == 1 for v in range(1, 6))
+
+def test_tail_falls_back_to_the_snapshot(ledger):
+    commit(ledger, [1])
+    ledger.write_snapshot()
+    commit(ledger, [2])
+    head = ledger.read_tail()
+    os.remove(ledger._path("tail"))
+    reopened = VoteLedger(ledger.directory)
+    with reopened._locked():
+        assert reopened._recover() == head
+    assert reopened.stats["recovered"] == 2
@@ -0,0 +1,82 @@
+import glob
+import gzip
+import json
+import logging
+import multiprocessing
+import os
+
+from log_handlers import JSONLogFormatter, RotatingJSONLogHandler
+
+def make_logger(path: str, max_bytes: int = 0, rotate_seconds: int = 0, name: str = "writer") -> logging.Logger:
+    handler = RotatingJSONLogHandler(path, max_bytes, 1000, rotate_seconds)
+    handler.setFormatter(JSONLogFormatter())
+    logger = logging.getLogger(f"evoting.test.{name}.{path}")
+    logger.handlers = [handler]
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    return logger
+
+def read_lines(path: str) -> list:
+    lines = []
+    for name in glob.glob(path + "*"):
+        if name.endswith(".lock"):
+            continue
+        opener = gzip.open if name.endswith(".gz") else open
+        with opener(name, "rt", encoding="utf-8") as f:
+            lines.extend(json.loads(line) for line in f)
+    return lines
+
+def write_lines(path: str, worker: int, count: int):
+    logger = make_logger(path, max_bytes=4096, name=f"worker{worker}")
+    for n in range(count):
+        logger.info("worker %d line %d", worker, n)
+
+def test_lines_are_json(tmp_path):
+    path = str(tmp_path / "evoting.log")
+    make_logger(path).warning("hello %s", "world")
+    (entry,) = read_lines(path)
+    assert entry["message"] == "hello world"
+    assert entry["level"] == "WARNING"
+
+def test_rotation_across_processes_loses_and_duplicates_nothing(tmp_path):
+    path = str(tmp_path / "evoting.log")
+    workers, count = 4, 500
+    context = multiprocessing.get_context("fork")
+    processes = [context.Process(target=write_lines, args=(path, worker, count)) for worker in range(workers)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join(60)
+        assert process.exitcode == 0
+    messages = [entry["message"] for entry in read_lines(path)]
+    assert len(glob.glob(path + ".*.gz")) > 1
+    assert len(messages) == workers * count
+    assert set(messages) == {f"worker {w} line {n}" for w in range(workers) for n in range(count)}
+
+def test_rotates_on_age(tmp_path):
+    path = str(tmp_path / "evoting.log")
+    logger = make_logger(path, rotate_seconds=60)
+    logger.info("before")
+    handler = logger.handlers[0]
+    # Pretend the last rotation was two minutes ago
+    os.ftruncate(handler._lock_file(), 0)
+    os.pwrite(handler._lock_file(), b"0.0", 0)
+    handler.rollover_at = 0
+    logger.info("after")
+    with gzip.open(path + ".1.gz", "rt") as f:
+        assert json.loads(f.read())["message"] == "before"
+    with open(path, encoding="utf-8") as f:
+        assert json.loads(f.read())["message"] == "after"
+
+def test_rotation_done_by_another_process_is_not_repeated(tmp_path):
+    path = str(tmp_path / "evoting.log")
+    first, second = (make_logger(path, max_bytes=1000, name=name) for name in ("first", "second"))
+    first.info("first opens the file")
+    second.info("second opens the file")
+    first.info("x" * 700)
+    first.info("first rotates")
+    # second's stream still points at the rotated file; it reopens instead of rotating again
+    second.info("second writes into the new file")
+    assert len(glob.glob(path + ".*.gz")) == 1
+    with open(path, encoding="utf-8") as f:
+        assert [json.loads(line)["message"] for line in f] == ["first rotates", "second writes into the new file"]
@@ -0,0 +1,177 @@
+import re
+
+import pytest
+
+from migrations import add_index, apply_migrations, split_sql_statements
+
+class FakeDatabase:
+    """The slice of MySQL the runner talks to: schema_version, indexes, DDL that commits itself."""
+    def __init__(self, tables=()):
+        self.tables = set(tables)
+        self.indexes = {}
+        self.versions = []
+        self.ddl = []
+        self.fail_on = None
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+        self.db = conn.db
+        self.result = []
+
+    def execute(self, sql, params=()):
+        sql = " ".join(sql.split())
+        if self.db.fail_on and self.db.fail_on in sql:
+            raise RuntimeError(f"failed: {sql}")
+        self.result = []
+        if sql.startswith("SELECT GET_LOCK"):
+            self.result = [(1,)]
+        elif sql.startswith("SELECT RELEASE_LOCK"):
+            self.result = [(1,)]
+        elif sql.startswith("CREATE TABLE IF NOT EXISTS"):
+            self.db.tables.add(sql.split()[5])
+        elif sql.startswith("SELECT COALESCE(MAX(version), 0)"):
+            versions = self.db.versions + [v for v, _ in self.conn.pending]
+            self.result = [(max(versions, default=0),)]
+        elif sql.startswith("INSERT INTO schema_version"):
+            self.conn.pending.append(params)
+        elif "information_schema.TABLES" in sql:
+            self.result = [(int(params[0] in self.db.tables),)]
+        elif "information_schema.STATISTICS" in sql:
+            self.result = [(column,) for column in self.db.indexes.get(params, [])]
+        elif sql.startswith("ALTER TABLE"):
+            table, name, columns = re.match(r"ALTER TABLE (\w+) ADD \w+(?: KEY)? (\w+) \((.*)\)", sql).groups()
+            self.db.indexes[(table, name)] = [c.strip() for c in columns.split(",")]
+            self.db.ddl.append(sql)
+            self.conn.commit()  # DDL commits implicitly
+        else:
+            raise AssertionError(f"unexpected SQL: {sql}")
+
+    def fetchone(self):
+        return self.result[0] if self.result else None
+
+    def fetchall(self):
+        return self.result
+
+    def close(self):
+        pass
+
+class FakeConnection:
+    def __init__(self, db):
+        self.db = db
+        self.pending = []
+        self.closed = False
+        self.rolled_back = False
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def commit(self):
+        self.db.versions.extend(version for version, _ in self.pending)
+        self.pending = []
+
+    def rollback(self):
+        self.rolled_back = True
+        self.pending = []
+
+    def close(self):
+        self.closed = True
+
+def migrations(fail=False):
+    def risky(cur):
+        add_index(cur, "votes", "INDEX idx_votes_hash (vote_hash)")
+        if fail:
+            raise RuntimeError("disk full")
+        add_index(cur, "votes", "INDEX idx_votes_time (cast_at)")
+
+    return [
+        (1, "baseline", ["CREATE TABLE IF NOT EXISTS votes (vote_id INT)"]),
+        (2, "audit index", [lambda cur: add_index(cur, "audit_logs", "INDEX idx_audit_action (action, log_id)")]),
+        (3, "vote indexes", risky),
+    ]
+
+def run(db, steps=None):
+    conn = FakeConnection(db)
+    try:
+        return apply_migrations(conn, steps or migrations(), echo=lambda message: None)
+    finally:
+        assert conn.closed
+
+def test_applies_pending_migrations_once():
+    db = FakeDatabase()
+    assert run(db) == [1, 2, 3]
+    assert db.indexes[("audit_logs", "idx_audit_action")] == ["action", "log_id"]
+    assert run(db) == []
+    assert len(db.ddl) == 3
+
+def test_failed_run_is_resumed_without_repeating_ddl():
+    db = FakeDatabase()
+    with pytest.raises(RuntimeError, match="disk full"):
+        run(db, migrations(fail=True))
+    assert db.versions == [1, 2]
+    assert ("votes", "idx_votes_hash") in db.indexes  # committed by MySQL before the failure
+    assert run(db) == [3]
+    assert db.ddl.count("ALTER TABLE votes ADD INDEX idx_votes_hash (vote_hash)") == 1
+    assert run(db) == []
+
+def test_failed_step_is_rolled_back():
+    db = FakeDatabase()
+    conn = FakeConnection(db)
+    with pytest.raises(RuntimeError):
+        apply_migrations(conn, migrations(fail=True), echo=lambda message: None)
+    assert conn.rolled_back
+    assert conn.pending == []
+
+def test_existing_schema_is_adopted_as_the_baseline():
+    db = FakeDatabase(tables={"voters"})
+    assert run(db) == [2, 3]
+    assert db.versions[0] == 1
+
+def test_lock_release_failure_does_not_mask_the_error():
+    db = FakeDatabase()
+    run(db, migrations()[:1])
+    db.fail_on = "RELEASE_LOCK"
+    with pytest.raises(RuntimeError, match="disk full"):
+        run(db, migrations(fail=True))
+    assert db.versions == [1, 2]
+
+def test_rollback_failure_does_not_mask_the_error():
+    db = FakeDatabase()
+    conn = FakeConnection(db)
+
+    def broken_rollback():
+        raise OSError("connection lost")
+
+    conn.rollback = broken_rollback
+    with pytest.raises(RuntimeError, match="disk full"):
+        apply_migrations(conn, migrations(fail=True), echo=lambda message: None)
+    assert conn.closed
+
+def test_lock_timeout():
+    db = FakeDatabase()
+    conn = FakeConnection(db)
+    cursor = FakeCursor(conn)
+    execute = cursor.execute
+
+    def timed_out(sql, params=()):
+        execute(sql, params)
+        if "GET_LOCK" in sql:
+            cursor.result = [(0,)]
+
+    cursor.execute = timed_out
+    conn.cursor = lambda: cursor
+    with pytest.raises(RuntimeError, match="migration lock"):
+        apply_migrations(conn, migrations(), echo=lambda message: None)
+    assert db.versions == []
+
+def test_split_sql_statements():
+    script = r"""
+    CREATE DATABASE evoting; USE evoting;
+    -- a comment; with a semicolon
+    INSERT INTO t VALUES ('a;b', 'c\';d');
+    CREATE TABLE `x;y` (id INT)
+    """
+    assert split_sql_statements(script) == [
+        r"INSERT INTO t VALUES ('a;b', 'c\';d')",
+        "CREATE TABLE `x;y` (id INT)",
+    ]
@@ -0,0 +1,132 @@
+import os
+import threading
+import time
+
+import pytest
+from flask import Flask, session
+
+from session_store import RedisSessionStore, SQLiteSessionStore, ServerSideSessionInterface
+
+class RedisStandIn:
+    """Just enough of redis.Redis for RedisSessionStore, expiring keys like Redis does."""
+    def __init__(self):
+        self.data = {}
+        self.now = 0
+
+    def get(self, key):
+        value, expires_at = self.data.get(key, (None, 0))
+        return value if expires_at > self.now else None
+
+    def set(self, key, value, ex):
+        assert isinstance(ex, int) and ex > 0
+        self.data[key] = (value, self.now + ex)
+
+    def delete(self, key):
+        self.data.pop(key, None)
+
+@pytest.fixture
+def sqlite_store(tmp_path):
+    return SQLiteSessionStore(str(tmp_path / "sessions.sqlite3"))
+
+@pytest.fixture(params=["sqlite", "redis"])
+def store(request, tmp_path):
+    if request.param == "sqlite":
+        return SQLiteSessionStore(str(tmp_path / "sessions.sqlite3"))
+    return RedisSessionStore("redis://stand-in", client=RedisStandIn())
+
+def test_round_trip(store):
+    store.set("sid", b'{"user": 1}', 60)
+    assert store.get("sid") == b'{"user": 1}'
+    store.delete("sid")
+    assert store.get("sid") is None
+
+def test_expired_entries_are_not_returned(sqlite_store):
+    sqlite_store.set("sid", b"{}", 0.05)
+    time.sleep(0.1)
+    assert sqlite_store.get("sid") is None
+
+def test_redis_keys_are_prefixed_and_expire_in_whole_seconds():
+    store = RedisSessionStore("redis://stand-in", client=RedisStandIn())
+    store.set("sid", b"{}", 0.2)
+    assert list(store.client.data) == ["evoting:session:sid"]
+    assert store.get("sid") == b"{}"
+    store.client.now = 1
+    assert store.get("sid") is None
+
+def test_sweep_removes_only_expired_rows(sqlite_store):
+    sqlite_store.set("old", b"{}", 0.05)
+    sqlite_store.set("live", b"{}", 60)
+    time.sleep(0.1)
+    assert sqlite_store.sweep() == 1
+    assert sqlite_store.sweep() == 0
+    assert sqlite_store.get("live") == b"{}"
+
+def test_store_is_shared_across_threads(sqlite_store):
+    thread = threading.Thread(target=sqlite_store.set, args=("sid", b"{}", 60))
+    thread.start()
+    thread.join()
+    assert sqlite_store.get("sid") == b"{}"
+
+def test_store_and_sweeper_start_on_first_use(tmp_path):
+    path = tmp_path / "sessions.sqlite3"
+    interface = ServerSideSessionInterface(lambda: SQLiteSessionStore(str(path)), sweep_interval=60)
+    assert not path.exists()
+    assert not any(t.name == "session-sweeper" for t in threading.enumerate())
+    store = interface.store
+    assert path.exists()
+    assert interface.store is store
+    assert sum(t.name == "session-sweeper" for t in threading.enumerate()) >= 1
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="needs fork")
+def test_forked_child_gets_its_own_store(tmp_path):
+    interface = ServerSideSessionInterface(lambda: SQLiteSessionStore(str(tmp_path / "s.sqlite3")))
+    parent_store = interface.store
+    read, write = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.write(write, b"1" if interface.store is not parent_store else b"0")
+        os._exit(0)
+    os.waitpid(pid, 0)
+    assert os.read(read, 1) == b"1"
+
+@pytest.fixture
+def app(tmp_path):
+    app = Flask(__name__)
+    app.secret_key = "test"
+    app.session_interface = ServerSideSessionInterface(lambda: SQLiteSessionStore(str(tmp_path / "s.sqlite3")))
+
+    @app.route("/set/<value>")
+    def set_value(value):
+        session["value"] = value
+        return "ok"
+
+    @app.route("/get")
+    def get_value():
+        return session.get("value", "")
+
+    @app.route("/clear")
+    def clear():
+        session.clear()
+        return "ok"
+
+    return app
+
+def test_session_lives_in_the_store_not_the_cookie(app):
+    client = app.test_client()
+    client.get("/set/secret-value")
+    cookie = client.get_cookie("session")
+    assert "secret-value" not in cookie.value
+    assert client.get("/get").data == b"secret-value"
+
+def test_tampered_cookie_starts_a_new_session(app):
+    client = app.test_client()
+    client.get("/set/a")
+    client.set_cookie("session", client.get_cookie("session").value + "x")
+    assert client.get("/get").data == b""
+
+def test_clearing_the_session_deletes_it_from_the_store(app):
+    client = app.test_client()
+    client.get("/set/a")
+    client.get("/clear")
+    store = app.session_interface.store
+    assert store._connection().execute("SELECT COUNT(*) FROM sessions").fetchone()[0] == 0